@@ -1,194 +1,617 @@
-import io
-import os
-import json
-import pandas as pd
-import requests
-from fastapi import FastAPI, Request, UploadFile, File, Form
+import os, io, uuid, time, datetime, asyncio, sqlite3, codecs
+from typing import List, Dict, Any, Optional, Tuple
+from fastapi import FastAPI, Request, UploadFile, Form, Depends, HTTPException, status, Query
 from fastapi.responses import HTMLResponse, FileResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
-from datetime import datetime
-
-# יצירת אפליקציה FastAPI
-app = FastAPI()
-
-# חיבור לתיקיות סטטיות ותבניות
+from fastapi.security import HTTPBasic, HTTPBasicCredentials
+from dotenv import load_dotenv
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pac
+import charset_normalizer
+import aiohttp
+import orjson
+
+
+CSV_BLOCK_SIZE = 1 << 20
+
+def _read_table_from_upload(filename: str, content: bytes, stream: bool = False, invalid_rows: Optional[List[str]] = None):
+    # stream=True מחזיר איטרטור של DataFrames - אחד לכל record batch (בערך CSV_BLOCK_SIZE bytes) - במקום DataFrame אחד.
+    # שורות CSV עם מספר עמודות שגוי מדולגות והטקסט שלהן נאסף ל-invalid_rows; קובץ שלא ניתן לפרסר מעלה pa.ArrowInvalid
+    name = (filename or "").lower()
+    if name.endswith(".xlsx") or name.endswith(".xls"):
+        # Excel - sheet ראשון
+        df = pd.read_excel(io.BytesIO(content), sheet_name=0)
+        return iter([df]) if stream else df
+    # default CSV - מזהים קידוד מראש ו-pyarrow מפרסר ב-C++ על כמה threads ישר לעמודות Arrow.
+    # קודם UTF-8 קפדני (כולל BOM); רק אם נכשל מזהים, ומוגבל ל-UTF-16/windows-1255 - זיהוי חופשי מבלבל את 1255 עם cp1250/koi8_r
+    head = content[:65536]
+    try:
+        codecs.getincrementaldecoder("utf-8")().decode(head)
+        enc = "utf8"
+    except UnicodeDecodeError:
+        best = charset_normalizer.from_bytes(head, cp_isolation=["utf_16", "cp1255"]).best()
+        enc = best.encoding if best else "cp1255"
+    read_options = pac.ReadOptions(block_size=CSV_BLOCK_SIZE, encoding=enc)
+    # שמות העמודות כמו שהם בקובץ ("SKU", " sku") - ה-lower/strip קורה רק אחרי הפרסור.
+    # כל העמודות נקראות כטקסט: 00123 לא הופך ל-123, והסקת טיפוס לפי ה-block הראשון לא נשברת באמצע הקובץ
+    names = pac.open_csv(io.BytesIO(content), read_options=read_options,
+                         parse_options=pac.ParseOptions(invalid_row_handler=lambda row: "skip")).schema.names
+    if invalid_rows is None: invalid_rows = []
+    def _skip_row(row) -> str:
+        invalid_rows.append(row.text)
+        return "skip"
+    reader = pac.open_csv(io.BytesIO(content), read_options=read_options,
+                          parse_options=pac.ParseOptions(invalid_row_handler=_skip_row),
+                          convert_options=pac.ConvertOptions(column_types={n: pa.string() for n in names}))
+    if not stream:
+        return reader.read_all().to_pandas(split_blocks=True, self_destruct=True)
+    def _frames():
+        # רק ה-record batch הנוכחי נמצא בזיכרון; קובץ עם כותרת בלבד מחזיר DataFrame ריק עם העמודות
+        empty = True
+        for batch in reader:
+            empty = False
+            yield batch.to_pandas()
+        if empty:
+            yield reader.schema.empty_table().to_pandas()
+    return _frames()
+
+load_dotenv()
+# השמות הישנים (WOOCOMMERCE_URL/KEY/SECRET) עדיין נתמכים, כדי שפריסה קיימת לא תקבל WC_SITE=None בשקט
+WC_SITE = (os.getenv("WC_SITE") or os.getenv("WOOCOMMERCE_URL") or "").rstrip("/") or None
+CK = os.getenv("WC_CK") or os.getenv("WOOCOMMERCE_KEY")
+CS = os.getenv("WC_CS") or os.getenv("WOOCOMMERCE_SECRET")
+# אין סיסמת ברירת מחדל - בלי APP_USER/APP_PASS האפליקציה לא עולה
+APP_USER = os.getenv("APP_USER")
+APP_PASS = os.getenv("APP_PASS")
+WC_RPS = int(os.getenv("WC_RPS") or 10)
+
+LOG_DIR = os.path.abspath("./logs")
+os.makedirs(LOG_DIR, exist_ok=True)
+
+app = FastAPI(title="Go Tactical - Inventory Uploader")
 app.mount("/static", StaticFiles(directory="static"), name="static")
 templates = Jinja2Templates(directory="templates")
+security = HTTPBasic()
+
+@app.on_event("startup")
+async def _check_config():
+    # נרשם ראשון - נכשל מיד עם הודעה ברורה, לפני שבקשה כלשהי הולכת ל-"None/wp-json/..."
+    required = {"WC_SITE (or WOOCOMMERCE_URL)": WC_SITE, "WC_CK (or WOOCOMMERCE_KEY)": CK,
+                "WC_CS (or WOOCOMMERCE_SECRET)": CS, "APP_USER": APP_USER, "APP_PASS": APP_PASS}
+    missing = [name for name, value in required.items() if not value]
+    if missing:
+        raise RuntimeError(f"Missing required environment variables: {', '.join(missing)}")
+
+def require_auth(credentials: HTTPBasicCredentials = Depends(security)):
+    if not (credentials.username == APP_USER and credentials.password == APP_PASS):
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Not authenticated", headers={"WWW-Authenticate": "Basic"})
+    return True
+
+WC_PARAMS: Dict[str, str] = {"consumer_key": CK, "consumer_secret": CS} if CK and CS else {}
+WC_AUTH = aiohttp.BasicAuth(CK, CS) if CK and CS else None
+RESOLVE_CONCURRENCY = 20
+SKU_CHUNK = 100
+BATCH_CONCURRENCY = 8
+BATCH_SIZE = 100
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+class RateLimiter:
+    # token bucket: כל כניסה תופסת token שמשתחרר שנייה אחרי - לכל היותר rps בקשות בכל חלון של שנייה
+    def __init__(self, rps: int):
+        self.sem = asyncio.Semaphore(rps)
+
+    async def __aenter__(self):
+        await self.sem.acquire()
+        asyncio.get_running_loop().call_later(1.0, self.sem.release)
+
+    async def __aexit__(self, *exc):
+        return False
+
+# משותף לכל הבקשות ל-WooCommerce (שליפת SKU, סריקת וריאציות ו-batch PUT), מתחת ל-rate limit של השרת
+RATE_LIMITER = RateLimiter(WC_RPS)
+
+@app.on_event("startup")
+async def _open_http_session():
+    # session אחד לכל חיי האפליקציה - חיבורי keep-alive משותפים לכל הבקשות ל-WooCommerce
+    # keep-alive ארוך + cache ל-DNS: ה-handshake של TLS משולם פעם אחת לחיבור ולא פעם לבקשה
+    connector = aiohttp.TCPConnector(limit=100, limit_per_host=50, keepalive_timeout=60, ttl_dns_cache=300)
+    app.state.http = aiohttp.ClientSession(connector=connector, headers={"Accept": "application/json"})
+
+@app.on_event("shutdown")
+async def _close_http_session():
+    await app.state.http.close()
+
+VARIATION_INDEX: Dict[str, Tuple[int, int]] = {}
+VARIATION_INDEX_UPDATED = 0.0
+
+# האינדקס נשמר ב-SQLite לפי אתר, כדי שאחרי restart לא נצטרך לסרוק את כל הקטלוג מחדש
+VIDX_CACHE_PATH = os.path.join(LOG_DIR, "variation_index.sqlite")
+VIDX_MAX_AGE = 24 * 3600
+VIDX_MIN_RECRAWL = 300
+
+def _vidx_connect() -> sqlite3.Connection:
+    conn = sqlite3.connect(VIDX_CACHE_PATH)
+    conn.execute("CREATE TABLE IF NOT EXISTS vidx(site TEXT, sku TEXT, parent_id INT, variation_id INT, updated REAL, PRIMARY KEY(site, sku))")
+    return conn
+
+def _load_variation_index() -> float:
+    conn = _vidx_connect()
+    try:
+        rows = conn.execute("SELECT sku, parent_id, variation_id, updated FROM vidx WHERE site = ? AND updated > ?",
+                            (WC_SITE or "", time.time() - VIDX_MAX_AGE)).fetchall()
+    finally:
+        conn.close()
+    VARIATION_INDEX.update({sku: (parent_id, variation_id) for sku, parent_id, variation_id, _ in rows})
+    return min((r[3] for r in rows), default=0.0)
+
+def _save_variation_index(index: Dict[str, Tuple[int, int]], updated: float) -> None:
+    conn = _vidx_connect()
+    try:
+        with conn:
+            conn.execute("DELETE FROM vidx WHERE site = ?", (WC_SITE or "",))
+            conn.executemany("INSERT INTO vidx VALUES (?, ?, ?, ?, ?)",
+                             [(WC_SITE or "", sku, parent_id, variation_id, updated) for sku, (parent_id, variation_id) in index.items()])
+    finally:
+        conn.close()
+
+@app.on_event("startup")
+async def _load_variation_index_cache():
+    global VARIATION_INDEX_UPDATED
+    VARIATION_INDEX_UPDATED = await asyncio.to_thread(_load_variation_index)
+
+# token -> חלקי ה-DataFrame מה-preview בפורמט Arrow IPC (feather), עד ש-/apply מסיים בהצלחה.
+# ה-cache הוא בזיכרון של התהליך: עם `uvicorn --workers N` ה-/apply עלול להגיע ל-worker אחר ולקבל 404
+# כל רשומה היא (זמן יצירה, blobs); preview נטוש פג אחרי PREVIEW_CACHE_TTL, וסך ה-bytes חסום ב-PREVIEW_CACHE_MAX_BYTES
+PREVIEW_CACHE: Dict[str, Tuple[float, List[bytes]]] = {}
+PREVIEW_CACHE_MAX = 20
+PREVIEW_CACHE_TTL = 45 * 60
+PREVIEW_CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+def _prune_preview_cache() -> None:
+    # ה-dict שומר סדר הכנסה, כך שהרשומה הראשונה היא תמיד הישנה ביותר
+    now = time.time()
+    for token in [t for t, (created, _) in PREVIEW_CACHE.items() if now - created > PREVIEW_CACHE_TTL]:
+        del PREVIEW_CACHE[token]
+    total = sum(len(b) for _, blobs in PREVIEW_CACHE.values() for b in blobs)
+    while PREVIEW_CACHE and (len(PREVIEW_CACHE) > PREVIEW_CACHE_MAX or total > PREVIEW_CACHE_MAX_BYTES):
+        _, blobs = PREVIEW_CACHE.pop(next(iter(PREVIEW_CACHE)))
+        total -= sum(len(b) for b in blobs)
+
+async def _wc_get_page(url: str, attempts: int = 3, **params) -> Tuple[Any, int]:
+    # מחזיר (json, X-WP-TotalPages); 429/5xx - ניסיון חוזר עם backoff מעריכי כמו ב-_wc_put
+    for a in range(attempts):
+        async with RATE_LIMITER, app.state.http.get(url, params={**WC_PARAMS, **params}) as r:
+            if r.status not in RETRY_STATUSES or a == attempts - 1:
+                r.raise_for_status()
+                return await r.json(loads=orjson.loads, content_type=None), int(r.headers.get("X-WP-TotalPages") or 1)
+            await r.read()
+        # ההמתנה אחרי שה-response נסגר - החיבור חוזר ל-pool ולא נשאר תפוס בזמן ה-backoff
+        await asyncio.sleep(2 ** a)
+
+def _wc_error(e: Exception) -> str:
+    # בלי ה-URL - הוא כולל את consumer_secret ומגיע גם למסך וגם ללוג
+    if isinstance(e, aiohttp.ClientResponseError):
+        return f"{e.status}: {e.message}"
+    return str(e)
+
+async def _wc_get(url: str, **params) -> Any:
+    data, _ = await _wc_get_page(url, **params)
+    return data
+
+async def _wc_put(url: str, payload: Dict[str, Any], attempts: int = 3) -> Tuple[int, Any]:
+    # 429/5xx - ניסיון חוזר עם backoff מעריכי (1s, 2s, ...)
+    for a in range(attempts):
+        async with RATE_LIMITER, app.state.http.put(url, data=orjson.dumps(payload), headers={"Content-Type": "application/json"}, auth=WC_AUTH) as r:
+            if r.status not in RETRY_STATUSES or a == attempts - 1:
+                if r.status >= 400:
+                    return r.status, await r.text()
+                return r.status, await r.json(loads=orjson.loads, content_type=None)
+            await r.read()
+        await asyncio.sleep(2 ** a)
+
+async def _wc_get_all(url: str, **params) -> List[Any]:
+    # העמוד הראשון מחזיר X-WP-TotalPages, ואת שאר העמודים מושכים במקביל
+    first, total_pages = await _wc_get_page(url, page=1, **params)
+    rest = await asyncio.gather(*[_wc_get(url, page=page, **params) for page in range(2, total_pages + 1)])
+    return first + [item for page in rest for item in page]
+
+async def warm_variation_index(force: bool = False) -> bool:
+    # מחזיר True אם הקטלוג נסרק עכשיו, False אם האינדקס מה-cache עדיין בתוקף
+    global VARIATION_INDEX_UPDATED
+    if not force and VARIATION_INDEX and time.time() - VARIATION_INDEX_UPDATED < VIDX_MAX_AGE:
+        return False
+    products_url = f"{WC_SITE}/wp-json/wc/v3/products"
+    parents = await _wc_get_all(products_url, type="variable", per_page=100, _fields="id")
+    async def _variations(parent_id: int):
+        variations_url = f"{WC_SITE}/wp-json/wc/v3/products/{parent_id}/variations"
+        return parent_id, await _wc_get_all(variations_url, per_page=100, _fields="id,sku")
+    index: Dict[str, Tuple[int, int]] = {}
+    for parent_id, variations in await asyncio.gather(*[_variations(p["id"]) for p in parents]):
+        for v in variations:
+            vsku = (v.get("sku") or "").strip()
+            if vsku:
+                index[vsku] = (parent_id, v["id"])
+    VARIATION_INDEX.clear()
+    VARIATION_INDEX.update(index)
+    VARIATION_INDEX_UPDATED = time.time()
+    await asyncio.to_thread(_save_variation_index, index, VARIATION_INDEX_UPDATED)
+    return True
+
+# {sku: (kind, id, parent_id)}; SKU שהשליפה שלו נכשלה ממופה ל-Exception, SKU שלא נמצא לא מופיע
+async def resolve_skus_bulk(skus: List[str]) -> Dict[str, Any]:
+    out: Dict[str, Any] = {}
+    pending: List[str] = []
+    for sku in skus:
+        v = VARIATION_INDEX.get(sku)
+        if v:
+            parent_id, variation_id = v
+            out[sku] = ("variation", variation_id, parent_id)
+        else:
+            pending.append(sku)
+
+    # WooCommerce מקבל כמה SKU מופרדים בפסיק - בקשה אחת לכל 100 SKU
+    url = f"{WC_SITE}/wp-json/wc/v3/products"
+    sem = asyncio.Semaphore(RESOLVE_CONCURRENCY)
+    async def _lookup(chunk: List[str]):
+        async with sem:
+            return await _wc_get(url, sku=",".join(chunk), per_page=SKU_CHUNK, _fields="id,sku")
+    chunks = [pending[i:i+SKU_CHUNK] for i in range(0, len(pending), SKU_CHUNK)]
+    results = await asyncio.gather(*[_lookup(c) for c in chunks], return_exceptions=True)
+    for chunk, res in zip(chunks, results):
+        if isinstance(res, Exception):
+            out.update({sku: res for sku in chunk})
+            continue
+        for prod in res:
+            psku = (prod.get("sku") or "").strip()
+            if psku:
+                out[psku] = ("product", prod["id"], None)
+    return out
+
+# וריאציות שמופו מהאינדקס (cache): שליפה לכל הורה עם include=ids ובדיקה שכל id עדיין נושא את אותו SKU.
+# מחזיר את ה-SKU שלא אומתו - id שהוחלף/נמחק, הורה שנמחק, או שליפה שנכשלה
+async def stale_cached_variations(sku_map: Dict[str, Any]) -> List[str]:
+    by_parent: Dict[int, Dict[int, str]] = {}
+    for sku, res in sku_map.items():
+        if not isinstance(res, Exception) and res[0] == "variation":
+            by_parent.setdefault(res[2], {})[res[1]] = sku
+    sem = asyncio.Semaphore(RESOLVE_CONCURRENCY)
+    async def _check(parent_id: int, expected: Dict[int, str]) -> List[str]:
+        url = f"{WC_SITE}/wp-json/wc/v3/products/{parent_id}/variations"
+        ids = list(expected)
+        async with sem:
+            pages = await asyncio.gather(*[_wc_get_all(url, include=",".join(map(str, ids[i:i+SKU_CHUNK])), per_page=SKU_CHUNK, _fields="id,sku")
+                                           for i in range(0, len(ids), SKU_CHUNK)])
+        live = {v["id"]: (v.get("sku") or "").strip() for page in pages for v in page}
+        return [sku for vid, sku in expected.items() if live.get(vid) != sku]
+    parents = list(by_parent.items())
+    results = await asyncio.gather(*[_check(parent_id, expected) for parent_id, expected in parents], return_exceptions=True)
+    stale: List[str] = []
+    for (_, expected), res in zip(parents, results):
+        stale.extend(expected.values() if isinstance(res, Exception) else res)
+    return stale
+
+def _build_update_items(df: pd.DataFrame, do_stock: bool, do_prices: bool) -> pd.DataFrame:
+    # בניית ה-payload בצורה וקטורית - עמודה לכל שדה, None = השדה לא נשלח ל-WooCommerce
+    items = pd.DataFrame({"id": df["object_id"]}, index=df.index)
+    if do_stock:
+        qty = pd.to_numeric(df["quantity"], errors="coerce").fillna(0).astype(int).clip(lower=0)
+        items["manage_stock"] = True
+        items["stock_quantity"] = qty
+        items["stock_status"] = pd.Series("outofstock", index=df.index).mask(qty > 0, "instock")
+    def _price(col: str) -> pd.Series:
+        if not do_prices: return pd.Series(None, index=df.index, dtype=object)
+        s = df[col].fillna("").astype(str).str.strip()
+        return s.where(s != "", None)
+    rp = _price("regular_price"); sp = _price("sale_price")
+    items["regular_price"] = rp
+    items["sale_price"] = sp.mask(sp.isna() & rp.notna(), "")
+    items["has_update"] = rp.notna() | sp.notna() | do_stock
+    return items
+
+def _payload_records(items: pd.DataFrame) -> List[Dict[str, Any]]:
+    # itertuples(name=None) מחזיר tuple פשוט לכל שורה - בלי dict ביניים של to_dict ובלי namedtuple
+    items = items.astype(object).where(items.notna(), None)
+    cols = items.columns.tolist()
+    return [{k: v for k, v in zip(cols, row) if v is not None} for row in items.itertuples(index=False, name=None)]
+
+async def batch_update_products(products_payload: List[Dict[str, Any]]) -> Dict[str, Any]:
+    if not products_payload: return {"updated": 0, "errors": [], "items": []}
+    url = f"{WC_SITE}/wp-json/wc/v3/products/batch"
+    code, data = await _wc_put(url, {"update": products_payload})
+    if code >= 400:
+        return {"updated": 0, "errors": [f"{code}: {data}"], "items": []}
+    items = data.get("update", [])
+    return {"updated": sum(1 for it in items if "error" not in it), "errors": [], "items": items}
+
+async def batch_update_variations(parent_id: int, variations_payload: List[Dict[str, Any]]) -> Dict[str, Any]:
+    if not variations_payload: return {"updated": 0, "errors": [], "items": []}
+    url = f"{WC_SITE}/wp-json/wc/v3/products/{parent_id}/variations/batch"
+    code, data = await _wc_put(url, {"update": variations_payload})
+    if code >= 400:
+        return {"updated": 0, "errors": [f"{code}: {data}"], "items": []}
+    items = data.get("update", [])
+    return {"updated": sum(1 for it in items if "error" not in it), "errors": [], "items": items}
+
+def _batch_row_problems(rows: pd.DataFrame, items: List[Dict[str, Any]]) -> List[Optional[str]]:
+    # לכל שורה: None אם WooCommerce עדכן את ה-id הצפוי וה-SKU שלו עדיין זהה, אחרת תיאור הבעיה
+    by_id = {it.get("id"): it for it in items}
+    problems: List[Optional[str]] = []
+    for obj_id, sku in zip(rows["object_id"], rows["sku"]):
+        it = by_id.get(obj_id)
+        if it is None:
+            problems.append(f"{obj_id} לא הוחזר בתשובת ה-batch")
+        elif "error" in it:
+            err = it["error"]
+            problems.append(err.get("message", str(err)) if isinstance(err, dict) else str(err))
+        elif (it.get("sku") or "").strip() != sku:
+            problems.append(f"העדכון נכתב ל-{obj_id} שה-SKU שלו '{it.get('sku') or ''}' - בדוק את הפריט הזה ידנית")
+        else:
+            problems.append(None)
+    return problems
+
+LOG_FIELDS = ["sku","action","message","kind","parent_id","object_id","quantity","regular_price","sale_price"]
+
+def _new_log_name() -> str:
+    ts = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+    return f"log-{ts}-{uuid.uuid4().hex[:8]}.csv"
 
-# קריאת משתני סביבה (WooCommerce API)
-WOOCOMMERCE_URL = os.getenv("WOOCOMMERCE_URL", "")
-WOOCOMMERCE_KEY = os.getenv("WOOCOMMERCE_KEY", "")
-WOOCOMMERCE_SECRET = os.getenv("WOOCOMMERCE_SECRET", "")
+def _write_log_part(f, rows: Optional[pd.DataFrame]) -> None:
+    # rows=None כותב רק את שורת הכותרת
+    if rows is None:
+        pd.DataFrame(columns=LOG_FIELDS).to_csv(f, index=False)
+    else:
+        rows.reindex(columns=LOG_FIELDS).fillna("").to_csv(f, index=False, header=False)
 
+async def log_writer(name: str, queue: asyncio.Queue) -> None:
+    # צרכן יחיד: כותב לדיסק כל חלק לוג שנכנס לתור, במקביל לבקשות הרשת; None מסיים
+    f = await asyncio.to_thread(open, os.path.join(LOG_DIR, name), "w", newline="", encoding="utf-8")
+    try:
+        await asyncio.to_thread(_write_log_part, f, None)
+        while True:
+            rows = await queue.get()
+            try:
+                if rows is None: return
+                await asyncio.to_thread(_write_log_part, f, rows)
+            finally:
+                queue.task_done()
+    finally:
+        await asyncio.to_thread(f.close)
 
 @app.get("/", response_class=HTMLResponse)
-async def index(request: Request):
-    """עמוד הבית - העלאת קובץ"""
+def index(request: Request, _: bool = Depends(require_auth)):
     return templates.TemplateResponse("index.html", {"request": request})
 
-
 @app.post("/preview", response_class=HTMLResponse)
-async def preview(request: Request, file: UploadFile = File(...)):
-    """תצוגה מקדימה לפני עדכון"""
+async def preview(request: Request,
+                  file: UploadFile,
+                  do_stock: str = Form(default="off"),
+                  do_prices: str = Form(default="off"),
+                  dry_run: str = Form(default="off"),
+                  _: bool = Depends(require_auth)):
+    content = await file.read()
+    do_stock_bool = (do_stock == "on")
+    do_prices_bool = (do_prices == "on")
+    dry_run_bool = (dry_run == "on")
+
+    # קריאה בחלקים - הזיכרון חסום בגודל chunk ולא בגודל הקובץ
+    cols: List[str] = []
+    sample: List[Dict[str, Any]] = []
+    stats = {"total_rows": 0, "with_qty": 0, "with_rp": 0, "with_sp": 0}
+    blobs: List[bytes] = []
+    bad_total = 0
+    invalid_rows: List[str] = []
     try:
-        content = await file.read()
-        filename = file.filename.lower()
-
-        # זיהוי סוג הקובץ
-        if filename.endswith(".csv"):
-            df = pd.read_csv(io.BytesIO(content), encoding="utf-8", engine="python")
-        elif filename.endswith((".xls", ".xlsx")):
-            df = pd.read_excel(io.BytesIO(content), engine="openpyxl")
-        else:
-            return HTMLResponse(
-                content="<h2>שגיאה: פורמט קובץ לא נתמך (יש להשתמש ב־CSV או XLSX בלבד)</h2>",
-                status_code=400,
-            )
-
-        # בדיקת עמודות נדרשות
-        required_cols = {"sku", "quantity"}
-        if not required_cols.issubset(df.columns):
-            return HTMLResponse(
-                content=f"<h2>שגיאה: חסרות עמודות חובה ({', '.join(required_cols)})</h2>",
-                status_code=400,
-            )
-
-        # ניקוי ערכים ריקים
-        df = df.fillna("")
-        rows = df.to_dict(orient="records")
-
-        stats = {
-            "total_rows": len(df),
-            "unique_skus": df["sku"].nunique(),
-            "total_quantity": int(pd.to_numeric(df["quantity"], errors="coerce").fillna(0).sum()),
-        }
-
-        return templates.TemplateResponse(
-            "preview.html",
-            {
-                "request": request,
-                "rows": rows,
-                "stats": stats,
-                "errors": [],
-                "raw": df.to_json(orient="records"),
-                "do_stock": True,
-                "do_prices": False,
-                "dry_run": True,
-            },
-        )
-
-    except Exception as e:
-        import traceback
-        traceback.print_exc()
-        return HTMLResponse(
-            content=f"<h2>שגיאה פנימית בעת קריאת הקובץ:</h2><pre>{str(e)}</pre>",
-            status_code=500,
-        )
-
+        for df in _read_table_from_upload(file.filename, content, stream=True, invalid_rows=invalid_rows):
+            cols = [str(c).strip().lower() for c in df.columns]
+            df.columns = cols
+
+            if "sku" in df: df["sku"] = df["sku"].astype(str).str.strip()
+            if "quantity" in df: df["quantity"] = pd.to_numeric(df["quantity"], errors="coerce").fillna(0).astype(int)
+
+            if do_prices_bool:
+                if "regular_price" in df: df["regular_price"] = df["regular_price"].fillna("").astype(str).str.strip()
+                if "sale_price" in df: df["sale_price"] = df["sale_price"].fillna("").astype(str).str.strip()
+                # בדיקה וקטורית: sale גבוה מ-regular, או מחיר (כל אחד מהשניים) שמולא בערך לא מספרי
+                empty = pd.Series("", index=df.index)
+                rp = df["regular_price"] if "regular_price" in df else empty
+                sp = df["sale_price"] if "sale_price" in df else empty
+                rp_num = pd.to_numeric(rp, errors="coerce"); sp_num = pd.to_numeric(sp, errors="coerce")
+                bad = (sp_num > rp_num) | (rp.astype(bool) & rp_num.isna()) | (sp.astype(bool) & sp_num.isna())
+                if bad.any():
+                    df = df[~bad]
+                    bad_total += int(bad.sum())
+
+            if len(sample) < 10: sample.extend(df.head(10 - len(sample)).to_dict(orient="records"))
+            stats["total_rows"] += len(df)
+            if "quantity" in df: stats["with_qty"] += int(df["quantity"].notna().sum())
+            if "regular_price" in df: stats["with_rp"] += int(df["regular_price"].notna().sum())
+            if "sale_price" in df: stats["with_sp"] += int(df["sale_price"].notna().sum())
+            keep = ["sku", "quantity"] + (["regular_price", "sale_price"] if do_prices_bool else [])
+            buf = io.BytesIO()
+            df[[c for c in keep if c in df]].reset_index(drop=True).to_feather(buf)
+            blobs.append(buf.getvalue())
+    except pa.ArrowInvalid as e:
+        # קובץ ריק, קידוד שמשתנה באמצע הקובץ וכו' - 400 עם הסבר במקום 500
+        return templates.TemplateResponse("preview.html", {
+            "request": request,
+            "errors": [f"לא ניתן לקרוא את הקובץ: {e}"],
+            "rows": [],
+            "stats": stats,
+            "token": None,
+            "do_stock": do_stock_bool,
+            "do_prices": do_prices_bool,
+            "dry_run": dry_run_bool
+        }, status_code=400)
+
+    errors = []
+    if "sku" not in cols: errors.append("חסרה עמודת sku")
+    if do_stock_bool and "quantity" not in cols:
+        errors.append("סימנת עדכון מלאי אבל חסרה עמודת quantity")
+    if do_prices_bool and not (("regular_price" in cols) or ("sale_price" in cols)):
+        errors.append("סימנת עדכון מחירים אבל חסרות עמודות regular_price / sale_price")
+    if bad_total:
+        errors.append(f"נפסלו {bad_total} שורות עם sale_price גבוה מ-regular_price או ערכים לא תקינים.")
+    if invalid_rows:
+        errors.append(f"דולגו {len(invalid_rows)} שורות עם מספר עמודות שגוי, למשל: {invalid_rows[0][:80]}")
+
+    token = uuid.uuid4().hex
+    if sum(len(b) for b in blobs) > PREVIEW_CACHE_MAX_BYTES:
+        # לא נשמר בכלל - אחרת היה מפנה את כל שאר ה-previews ובכל זאת חורג מהתקרה
+        token = None
+        errors.append("הקובץ גדול מדי לשמירה עד אישור העדכון - פצל אותו לכמה קבצים.")
+    else:
+        PREVIEW_CACHE[token] = (time.time(), blobs)
+    _prune_preview_cache()
+    return templates.TemplateResponse("preview.html", {
+        "request": request,
+        "errors": errors,
+        "rows": sample,
+        "stats": stats,
+        "token": token,
+        "do_stock": do_stock_bool,
+        "do_prices": do_prices_bool,
+        "dry_run": dry_run_bool
+    })
 
 @app.post("/apply", response_class=HTMLResponse)
-async def apply_update(
-    request: Request,
-    raw: str = Form(...),
-    do_stock: bool = Form(True),
-    do_prices: bool = Form(False),
-    dry_run: bool = Form(True),
-):
-    """ביצוע העדכון בפועל"""
+async def apply(request: Request,
+                token: str = Form(...),
+                do_stock: str = Form(default="true"),
+                do_prices: str = Form(default="false"),
+                dry_run: str = Form(default="false"),
+                _: bool = Depends(require_auth)):
+    # get ולא pop - אם משהו בהמשך נכשל אפשר לשלוח שוב את אותו preview בלי להעלות מחדש
+    _prune_preview_cache()
+    entry = PREVIEW_CACHE.get(token)
+    if entry is None:
+        raise HTTPException(status_code=404, detail="Preview not found or expired")
+    _, blobs = entry
+    df = pd.concat([pd.read_feather(io.BytesIO(blob)) for blob in blobs], ignore_index=True) if blobs else pd.DataFrame()
+    do_stock_bool = (do_stock == "true")
+    do_prices_bool = (do_prices == "true")
+    dry_run_bool = (dry_run == "true")
+
+    for col in ("sku", "quantity", "regular_price", "sale_price"):
+        if col not in df: df[col] = None
+    if not do_stock_bool: df["quantity"] = None
+    if not do_prices_bool: df["regular_price"] = df["sale_price"] = None
+    df["sku"] = df["sku"].fillna("").astype(str).str.strip()
+    # SKU שמופיע כמה פעמים - השורה האחרונה בקובץ קובעת, וכל SKU נשלף מ-WooCommerce פעם אחת בלבד
+    df = df.loc[df["sku"] != "", ["sku", "quantity", "regular_price", "sale_price"]].drop_duplicates("sku", keep="last")
+
+    updated_total = 0
+    skus = df["sku"].tolist()
+    errors: List[str] = []
+    # סריקה שנכשלה לא מפילה את ההעלאה - ממשיכים עם האינדקס הקיים (מה-cache) ומדווחים שגיאה
+    crawled = False
     try:
-        df = pd.DataFrame(json.loads(raw))
-        not_found = []
-        updated = []
-        errors = []
-
-        for _, row in df.iterrows():
-            sku = str(row.get("sku", "")).strip()
-            qty = int(row.get("quantity", 0) or 0)
-            reg_price = row.get("regular_price", "")
-            sale_price = row.get("sale_price", "")
-
-            if not sku:
-                continue
-
-            if dry_run:
-                updated.append(sku)
-                continue
-
-            # בקשת WooCommerce לפי SKU
-            endpoint = f"{WOOCOMMERCE_URL}/wp-json/wc/v3/products?sku={sku}"
-            resp = requests.get(endpoint, auth=(WOOCOMMERCE_KEY, WOOCOMMERCE_SECRET))
-
-            if resp.status_code != 200:
-                errors.append(f"שגיאה בגישה ל־API עבור {sku}")
-                continue
-
-            products = resp.json()
-            if not products:
-                not_found.append(sku)
-                continue
-
-            product_id = products[0]["id"]
-            data = {}
-
-            if do_stock:
-                data["stock_quantity"] = qty
-                data["manage_stock"] = True
-            if do_prices:
-                if reg_price != "":
-                    data["regular_price"] = str(reg_price)
-                if sale_price != "":
-                    data["sale_price"] = str(sale_price)
-                else:
-                    data["sale_price"] = ""
-
-            # עדכון בפועל
-            put_url = f"{WOOCOMMERCE_URL}/wp-json/wc/v3/products/{product_id}"
-            r = requests.put(put_url, json=data, auth=(WOOCOMMERCE_KEY, WOOCOMMERCE_SECRET))
-            if r.status_code in (200, 201):
-                updated.append(sku)
+        if skus: crawled = await warm_variation_index()
+    except Exception as e:
+        errors.append(f"סריקת הוריאציות נכשלה: {_wc_error(e)}")
+    sku_map = await resolve_skus_bulk(skus)
+    # אינדקס מה-cache עלול לפספס וריאציות חדשות - סורקים מחדש רק אם באמת חסרים SKU
+    # (ולא יותר מפעם ב-VIDX_MIN_RECRAWL, כדי ש-SKU שגוי לא יגרור סריקה מלאה בכל העלאה)
+    missing = [sku for sku in skus if sku not in sku_map]
+    if missing and not crawled and time.time() - VARIATION_INDEX_UPDATED > VIDX_MIN_RECRAWL:
+        try:
+            crawled = await warm_variation_index(force=True)
+            sku_map.update(await resolve_skus_bulk(missing))
+        except Exception as e:
+            errors.append(f"סריקת הוריאציות נכשלה: {_wc_error(e)}")
+
+    # לפני כתיבה על סמך אינדקס מה-cache: מוודאים שכל id עדיין שייך ל-SKU, אחרת סורקים מחדש.
+    # אם גם הסריקה נכשלת ה-SKU האלה לא נכתבים בכלל - עדיף שגיאה מאשר מלאי שנכתב לפריט אחר
+    if not dry_run_bool and not crawled:
+        stale = await stale_cached_variations(sku_map)
+        if stale:
+            try:
+                crawled = await warm_variation_index(force=True)
+            except Exception as e:
+                crawl_error = RuntimeError(f"סריקת הוריאציות נכשלה: {_wc_error(e)}")
+                sku_map.update({sku: crawl_error for sku in stale})
             else:
-                errors.append(f"שגיאה בעדכון SKU {sku}: {r.text}")
-
-        summary = {
-            "updated_total": len(updated),
-            "not_found_count": len(not_found),
-            "not_found": not_found,
-            "errors_count": len(errors),
-            "errors": errors,
-            "log_name": f"log_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt",
-        }
-
-        # יצירת לוג
-        log_content = json.dumps(summary, ensure_ascii=False, indent=2)
-        log_path = f"/tmp/{summary['log_name']}"
-        with open(log_path, "w", encoding="utf-8") as f:
-            f.write(log_content)
-
-        return templates.TemplateResponse(
-            "result.html",
-            {"request": request, "summary": summary},
-        )
+                for sku in stale: sku_map.pop(sku, None)
+                sku_map.update(await resolve_skus_bulk(stale))
+
+    failed = {sku: res for sku, res in sku_map.items() if isinstance(res, Exception)}
+    resolved = pd.DataFrame([(sku, *res) for sku, res in sku_map.items() if sku not in failed],
+                            columns=["sku", "kind", "object_id", "parent_id"], dtype=object)
+    found = df.merge(resolved, on="sku")
+    lost = df[~df["sku"].isin(resolved["sku"]) & ~df["sku"].isin(list(failed))]
+    bad = df[df["sku"].isin(list(failed))]
+    not_found: List[str] = lost["sku"].tolist()
+    errors.extend(f"{sku}: {_wc_error(failed[sku])}" for sku in bad["sku"])
+
+    name = _new_log_name()
+    log_queue: asyncio.Queue = asyncio.Queue()
+    writer = asyncio.create_task(log_writer(name, log_queue))
+    try:
+        log_queue.put_nowait(lost.assign(action="not_found", message="SKU לא נמצא"))
+        log_queue.put_nowait(bad.assign(action="error", message=bad["sku"].map(lambda sku: _wc_error(failed[sku]))))
 
-    except Exception as e:
-        import traceback
-        traceback.print_exc()
-        return HTMLResponse(
-            content=f"<h2>שגיאה בעת עדכון הנתונים:</h2><pre>{str(e)}</pre>",
-            status_code=500,
-        )
+        items = _build_update_items(found, do_stock_bool, do_prices_bool)
+        log_queue.put_nowait(found[~items["has_update"]].assign(action="skipped", message="אין ערכים לעדכון"))
+        found = found[items["has_update"]]
+        items = items[items["has_update"]].drop(columns="has_update")
 
+        if dry_run_bool:
+            log_queue.put_nowait(found.assign(action="would_update", message=[orjson.dumps(p).decode() for p in _payload_records(items)]))
+        else:
+            is_product = found["kind"] == "product"
+            prod_items, prod_rows = items[is_product], found[is_product]
+            # (parent_id, items, rows) לכל batch; parent_id=None = מוצרים. ה-items נשארים עמודות עד שה-batch יוצא לרשת
+            batches = [(None, prod_items.iloc[i:i+BATCH_SIZE], prod_rows.iloc[i:i+BATCH_SIZE])
+                       for i in range(0, len(prod_items), BATCH_SIZE)]
+            for parent_id, group in items[~is_product].groupby(found.loc[~is_product, "parent_id"]):
+                rows = found.loc[group.index]
+                batches += [(int(parent_id), group.iloc[i:i+BATCH_SIZE], rows.iloc[i:i+BATCH_SIZE])
+                            for i in range(0, len(group), BATCH_SIZE)]
+
+            batch_sem = asyncio.Semaphore(BATCH_CONCURRENCY)
+            async def _run(parent_id: Optional[int], batch_items: pd.DataFrame, rows: pd.DataFrame) -> int:
+                async with batch_sem:
+                    # ה-dicts של ה-payload נבנים רק כאן, כך שבכל רגע קיימים לכל היותר BATCH_CONCURRENCY batches כאלה
+                    try:
+                        payload = _payload_records(batch_items)
+                        if parent_id is None:
+                            res = await batch_update_products(payload)
+                        else:
+                            res = await batch_update_variations(parent_id, payload)
+                    except Exception as e:
+                        res = {"updated": 0, "errors": [_wc_error(e)], "items": []}
+                # הלוג של ה-batch נכתב ברגע שהוא חוזר, בזמן ששאר ה-batches עדיין ברשת
+                if res["errors"]:
+                    errors.extend(res["errors"])
+                    log_queue.put_nowait(rows.assign(action="error", message="; ".join(res["errors"])))
+                    return 0
+                # כל שורה נבדקת מול תשובת ה-batch - id שלא חזר, שגיאה לפריט, או פריט עם SKU אחר נרשמים כשגיאה
+                problems = pd.Series(_batch_row_problems(rows, res["items"]), index=rows.index, dtype=object)
+                ok = problems.isna()
+                failed_rows = rows[~ok]
+                errors.extend(f"{sku}: {msg}" for sku, msg in zip(failed_rows["sku"], problems[~ok]))
+                log_queue.put_nowait(failed_rows.assign(action="error", message=problems[~ok]))
+                log_queue.put_nowait(rows[ok].assign(action="updated", message=rows.loc[ok, "kind"].map({"product": "מוצר עודכן", "variation": "וריאציה עודכנה"})))
+                return int(ok.sum())
+            updated_total += sum(await asyncio.gather(*[_run(*batch) for batch in batches]))
+    finally:
+        # ה-sentinel נשלח תמיד, גם אם משהו למעלה נכשל, כדי שה-writer לא יישאר תלוי
+        log_queue.put_nowait(None)
+        await writer
+
+    summary = {"updated_total": updated_total, "not_found": not_found[:50], "not_found_count": len(not_found), "errors": errors[:10], "errors_count": len(errors), "log_name": name, "dry_run": dry_run_bool}
+    response = templates.TemplateResponse("result.html", {"request": request, "summary": summary})
+    PREVIEW_CACHE.pop(token, None)
+    return response
 
 @app.get("/download-log", response_class=FileResponse)
-async def download_log(name: str):
-    """הורדת קובץ לוג"""
-    path = f"/tmp/{name}"
-    if os.path.exists(path):
-        return FileResponse(path, filename=name, media_type="text/plain")
-    return HTMLResponse(content="<h2>קובץ לוג לא נמצא</h2>", status_code=404)
-
+def download_log(name: str = Query(...), _: bool = Depends(require_auth)):
+    path = os.path.join(LOG_DIR, name)
+    if not os.path.isfile(path):
+        raise HTTPException(status_code=404, detail="Log not found")
+    return FileResponse(path, filename=name, media_type="text/csv")
 
 @app.get("/health", response_class=HTMLResponse)
-async def health():
-    """בדיקת תקינות בסיסית"""
+def health():
     return HTMLResponse("<h3>✅ האפליקציה פועלת כראוי</h3>")